@@ -1,17 +1,101 @@
+import base64
 import json
+import time
 
-from fastapi import APIRouter, File, UploadFile, HTTPException
-from services.evidence_service import uploading_evidence, get_evidence
-from schemas.payment import PaymentCreateRequest, PaymentUpdateRequest, PaymentCreateResponse
-from core.database import payments_collection, evidence_collection
+from fastapi import APIRouter, File, UploadFile, HTTPException, Query
+from services.evidence_service import uploading_evidence, get_evidence, delete_evidence
+from schemas.payment import PaymentCreateRequest, PaymentUpdateRequest, PaymentCreateResponse, PaymentListResponse
+from models.payment import Payment
+from core.database import payments_collection, evidence_collection, deleted_imports_collection, PAYMENT_FILTER_COLLATION, PAYMENT_IMPORT_KEY
 from typing import Optional
-from datetime import date, datetime
+from datetime import datetime
 from pymongo import DESCENDING
-from fastapi.responses import JSONResponse, FileResponse
 from bson import ObjectId
 
 router = APIRouter()
 
+# total_due = due_amount - discount + tax, with missing percentages treated as 0
+# (the CSV ingest's calculate_total_due stores the same value)
+TOTAL_DUE_EXPRESSION = {
+    "$round": [
+        {
+            "$let": {
+                "vars": {
+                    "d": {"$ifNull": ["$discount_percent", 0]},
+                    "t": {"$ifNull": ["$tax_percent", 0]},
+                },
+                "in": {
+                    "$add": [
+                        {"$subtract": ["$due_amount", {"$multiply": ["$due_amount", {"$divide": ["$$d", 100]}]}]},
+                        {"$multiply": ["$due_amount", {"$divide": ["$$t", 100]}]},
+                    ]
+                },
+            }
+        },
+        2,
+    ]
+}
+
+# Only the payment fields are read for listings; `total_due` is derived rather than fetched
+PAYMENT_LIST_PROJECTION = {field: 1 for field in Payment.model_fields if field != "total_due"}
+
+# Filtered counts are cached briefly so paging through one filter scans the matches once
+COUNT_CACHE_TTL_SECONDS = 30
+COUNT_CACHE_MAX_ENTRIES = 256
+_count_cache = {}
+
+async def _count_payments(query, collation=None):
+    if not query:
+        # Answered from collection metadata without scanning documents
+        return await payments_collection.estimated_document_count()
+
+    key = json.dumps(query, sort_keys=True, default=str)
+    now = time.monotonic()
+    cached = _count_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    if len(_count_cache) >= COUNT_CACHE_MAX_ENTRIES:
+        _count_cache.clear()
+    count = await payments_collection.count_documents(query, collation=collation)
+    _count_cache[key] = (now + COUNT_CACHE_TTL_SECONDS, count)
+    return count
+
+def _prefix_match(value: str):
+    # Values starting with `value`, as a range: compared in PAYMENT_FILTER_COLLATION this ignores
+    # case and walks only the matching part of the field's index. U+FFFF sorts after every character.
+    return {"$gte": value, "$lt": value + "\uffff"}
+
+def _encode_cursor(payment):
+    # Opaque cursor holding the (payee_due_date, _id) sort key of the last returned payment,
+    # taken from its response form (due dates are stored at midnight, so the date is exact)
+    key = {
+        "due": payment.get("payee_due_date"),
+        "id": payment["_id"],
+    }
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def _decode_cursor(cursor: str):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        due_date = datetime.fromisoformat(key["due"]) if key["due"] else None
+        return due_date, ObjectId(key["id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor format")
+
+def _after_cursor(due_date, payment_id):
+    # Payments that sort after the cursor in (payee_due_date desc, _id desc) order.
+    # Missing due dates sort last when descending, so they follow every dated payment.
+    if due_date is None:
+        return {"payee_due_date": None, "_id": {"$lt": payment_id}}
+    return {
+        "$or": [
+            {"payee_due_date": {"$lt": due_date}},
+            {"payee_due_date": due_date, "_id": {"$lt": payment_id}},
+            {"payee_due_date": None},
+        ]
+    }
+
 """
     Create a new payment record in the database.
 
@@ -31,16 +115,10 @@ router = APIRouter()
 @router.post("/create", response_model=PaymentCreateResponse)
 async def create_payment(payment: PaymentCreateRequest):
     # Prepare the payment data for insertion
-    payment_data = payment.dict()
-
-    if isinstance(payment.payee_added_date_utc, datetime):
-        payment_data['payee_added_date_utc'] = payment.payee_added_date_utc.strftime("%b %d, %Y, %I:%M %p")
-
-    if isinstance(payment.payee_due_date, date):
-        payment_data['payee_due_date'] = datetime.combine(payment.payee_due_date, datetime.min.time())  
+    payment_data = payment.model_dump()
     # Insert payment into the payments collection
     try:
-        result = payments_collection.insert_one(payment_data)
+        result = await payments_collection.insert_one(payment_data)
         # Return the ID of the newly created payment as a string
         return {"payment_id": str(result.inserted_id)}
     except Exception as e:
@@ -66,16 +144,10 @@ async def create_payment(payment: PaymentCreateRequest):
 @router.put("/update/{payment_id}")
 async def update_payment(payment_id: str, payment: PaymentUpdateRequest):
     # Prepare the payment data for update
-    payment_data = payment.dict()
-
-    if isinstance(payment.payee_added_date_utc, datetime):
-        payment_data['payee_added_date_utc'] = payment.payee_added_date_utc.strftime("%b %d, %Y, %I:%M %p")
-
-    if isinstance(payment.payee_due_date, date):
-        payment_data['payee_due_date'] = datetime.combine(payment.payee_due_date, datetime.min.time())  
+    payment_data = payment.model_dump()
     # Insert payment into the payments collection
     try:
-        result = payments_collection.update_one({"_id": ObjectId(payment_id)}, {"$set": payment_data})
+        result = await payments_collection.update_one({"_id": ObjectId(payment_id)}, {"$set": payment_data})
         return {"message":  "Payment updated successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating payment: {str(e)}")
@@ -106,17 +178,21 @@ async def delete_payment(payment_id: str):
         raise HTTPException(status_code=400, detail="Invalid payment ID format")
     
     # Check if the payment exists in the database
-    payment = payments_collection.find_one({"_id": payment_object_id})
+    payment = await payments_collection.find_one({"_id": payment_object_id}, {PAYMENT_IMPORT_KEY: 1})
     if not payment:
         raise HTTPException(status_code=404, detail="Payment not found")
+
+    # Remember deleted CSV-imported payments, so the next startup import doesn't bring them back
+    if payment.get(PAYMENT_IMPORT_KEY):
+        await deleted_imports_collection.update_one(
+            {"_id": payment[PAYMENT_IMPORT_KEY]}, {"$setOnInsert": {"deleted_at": datetime.utcnow()}}, upsert=True
+        )
     
     # Delete related evidence from the evidence collection (if any)
-    evidence = evidence_collection.find_one({"payment_id": payment_id})
-    if evidence:
-        evidence_collection.delete_many({"payment_id": payment_id})
+    await delete_evidence(payment_id)
     
     # Now delete the payment from the payments collection
-    result = payments_collection.delete_one({"_id": payment_object_id})
+    result = await payments_collection.delete_one({"_id": payment_object_id})
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Payment not found")
@@ -140,8 +216,7 @@ async def delete_payment(payment_id: str):
 """
 @router.post("/upload_evidence/{payment_id}")
 async def upload_evidence(payment_id: str, file: UploadFile = File(...)):
-    file_data = await file.read()
-    return uploading_evidence(payment_id, file_data, file.filename, file.content_type)
+    return await uploading_evidence(payment_id, file)
 
 """
     Download evidence related to a payment.
@@ -158,29 +233,33 @@ async def upload_evidence(payment_id: str, file: UploadFile = File(...)):
 """
 @router.get("/download_evidence/{payment_id}")
 async def download_evidence(payment_id: str):
-    return get_evidence(payment_id)
+    return await get_evidence(payment_id)
 
 """
     Fetch a list of payments, optionally filtered by country, city, or search query.
 
     This endpoint retrieves a list of payments from the database with support for filtering 
     by `payee_country`, `payee_city`, or a search query. It also supports pagination with 
-    `skip` and `limit` parameters.
+    `skip` and `limit` parameters, or with the `cursor` returned by a previous page.
 
     - **payee_country**: Filter payments by the country of the payee (optional).
     - **payee_city**: Filter payments by the city of the payee (optional).
-    - **search**: Search by payee's first name, last name, or email (optional).
+    - The other payee fields and `currency` filter the same way. Each text filter matches
+      values that start with the given text, ignoring case.
+    - **search**: Full-text search over the payee's name, address, contact details, status and currency (optional).
     - **skip**: Number of records to skip for pagination (default 0).
     - **limit**: Number of records to return (default 10).
+    - **cursor**: `nextCursor` from the previous page; takes precedence over `skip` (optional).
 
     Returns:
-        - A JSON object containing the filtered list of payments with relevant details.
+        - A JSON object containing the filtered list of payments with relevant details,
+          and `nextCursor` for fetching the following page (null on the last page).
 
     Raises:
         - HTTPException: If there is an error during the retrieval process.
 """
-@router.get("/get_payments")
-def get_payments(
+@router.get("/get_payments", response_model=PaymentListResponse)
+async def get_payments(
     payee_first_name: Optional[str] = None,
     payee_last_name: Optional[str] = None,
     payee_payment_status: Optional[str] = None,
@@ -193,102 +272,88 @@ def get_payments(
     payee_phone_number: Optional[str] = None,
     payee_email: Optional[str] = None,
     currency: Optional[str] = None,
-    skip: int = 1,
-    limit: int = 10,
+    search: Optional[str] = None,
+    skip: int = Query(1, ge=1),
+    limit: int = Query(10, ge=1, le=100),
+    cursor: Optional[str] = None,
 ):
-    today = datetime.combine(date.today(), datetime.min.time())
-
-    # Update `payee_payment_status` based on `payee_due_date`
-    payments_collection.update_many(
-        {"payee_due_date": {"$eq": today}, "payee_payment_status": {"$ne": "completed"},},
-        {"$set": {"payee_payment_status": "due_now"}}
-    )
-    payments_collection.update_many(
-        {"payee_due_date": {"$lt": today}, "payee_payment_status": {"$ne": "completed"},},
-        {"$set": {"payee_payment_status": "overdue"}}
-    )
-
-    # Calculate `total_due` for all records
-    payments = payments_collection.find()
-    for payment in payments:
-        discount = payment.get("discount_percent", 0) or 0
-        tax = payment.get("tax_percent", 0) or 0
-        due_amount = payment["due_amount"]
-        total_due = due_amount - (due_amount * discount / 100) + (due_amount * tax / 100)
-        payments_collection.update_one(
-            {"_id": payment["_id"]},
-            {"$set": {"total_due": round(total_due, 2)}}
-        )
-
-    # Build the query based on the fields passed from the frontend (only text fields)
+    # Build the query based on the fields passed from the frontend (only text fields, matched by
+    # case-insensitive prefix)
     query = {}
     if payee_first_name:
-        query["payee_first_name"] = {"$regex": payee_first_name, "$options": "i"}
+        query["payee_first_name"] = _prefix_match(payee_first_name)
     if payee_last_name:
-        query["payee_last_name"] = {"$regex": payee_last_name, "$options": "i"}
+        query["payee_last_name"] = _prefix_match(payee_last_name)
     if payee_payment_status:
-        query["payee_payment_status"] = {"$regex": payee_payment_status, "$options": "i"}
+        query["payee_payment_status"] = _prefix_match(payee_payment_status)
     if payee_address_line_1:
-        query["payee_address_line_1"] = {"$regex": payee_address_line_1, "$options": "i"}
+        query["payee_address_line_1"] = _prefix_match(payee_address_line_1)
     if payee_address_line_2:
-        query["payee_address_line_2"] = {"$regex": payee_address_line_2, "$options": "i"}
+        query["payee_address_line_2"] = _prefix_match(payee_address_line_2)
     if payee_city:
-        query["payee_city"] = {"$regex": payee_city, "$options": "i"}
+        query["payee_city"] = _prefix_match(payee_city)
     if payee_country:
-        query["payee_country"] = {"$regex": payee_country, "$options": "i"}
+        query["payee_country"] = _prefix_match(payee_country)
     if payee_province_or_state:
-        query["payee_province_or_state"] = {"$regex": payee_province_or_state, "$options": "i"}
+        query["payee_province_or_state"] = _prefix_match(payee_province_or_state)
     if payee_postal_code:
-        query["payee_postal_code"] = {"$regex": payee_postal_code, "$options": "i"}
+        query["payee_postal_code"] = _prefix_match(payee_postal_code)
     if payee_phone_number:
-        query["payee_phone_number"] = {"$regex": payee_phone_number, "$options": "i"}
+        query["payee_phone_number"] = _prefix_match(payee_phone_number)
     if payee_email:
-        query["payee_email"] = {"$regex": payee_email, "$options": "i"}
+        query["payee_email"] = _prefix_match(payee_email)
     if currency:
-        query["currency"] = {"$regex": currency, "$options": "i"}
-
-    # Pagination calculation
-    calculate_skip = (skip - 1) * limit
-    # Fetch filtered and paginated results
-    results = payments_collection.find(query).sort("payee_due_date", -1).skip(calculate_skip).limit(limit)
-
-    total_count = payments_collection.count_documents(query)
-
-    # Convert MongoDB results to JSON serializable format
-    payments_list = []
-    for payment in results:
-        payment_data = {
-            **{
-                key: (str(value) if key == "_id" else value)
-                for key, value in payment.items()
-                if key != "payee_due_date"  # Exclude payee_due_date temporarily
-            },
-            "payee_due_date": (
-                payment["payee_due_date"].isoformat().split("T")[0]
-                if isinstance(payment["payee_due_date"], datetime)
-                else payment["payee_due_date"]
-            ),
-        }
-
-        # Call `get_evidence` with the payment's payment_id (_id)
-        payment_id = str(payment["_id"])
-        evidence_response = get_evidence(payment_id)  # You can adjust this if needed for async calls
-
-        if isinstance(evidence_response, FileResponse):
-            # If file data is found, include it
-            payment_data["evidence_file"] = {
-                "file_found": True,
-                "file_name": evidence_response.headers["Content-Disposition"].split("=")[-1],
-            }
-        else:
-            # If no file data is found, include a message
-            evidence_data = evidence_response.body.decode()  # Decode the response body into a string
-            evidence_data = json.loads(evidence_data)  # Convert the JSON string into a Python dictionary
-            payment_data["evidence_file"] = {
-                "file_found": False,
-                "message": evidence_data.get("message", "No file data available"),  # Safely extract message
-            }
-
-        payments_list.append(payment_data)
-
-    return JSONResponse(content={"payments": payments_list, "totalCount": total_count})
\ No newline at end of file
+        query["currency"] = _prefix_match(currency)
+    # The prefix filters need their collation; unfiltered listings keep the default one
+    collation = PAYMENT_FILTER_COLLATION if query else None
+    if search:
+        query["$text"] = {"$search": search}
+
+    # Pagination: seek past the cursor when given, otherwise fall back to page offsets
+    if cursor:
+        page_query = {**query, **_after_cursor(*_decode_cursor(cursor))}
+        calculate_skip = 0
+    else:
+        page_query = query
+        calculate_skip = (skip - 1) * limit
+    # Fetch filtered and paginated results, deriving `total_due` on read
+    results = await payments_collection.aggregate([
+        {"$match": page_query},
+        {"$sort": {"payee_due_date": DESCENDING, "_id": DESCENDING}},
+        {"$skip": calculate_skip},
+        {"$limit": limit + 1},  # One extra row tells us whether another page exists
+        {"$project": PAYMENT_LIST_PROJECTION},
+        {"$addFields": {"total_due": TOTAL_DUE_EXPRESSION}},
+        # Attach the evidence file name in the same query (never the file contents)
+        {"$lookup": {
+            "from": evidence_collection.name,
+            "let": {"pid": {"$toString": "$_id"}},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$payment_id", "$$pid"]}}},
+                {"$limit": 1},
+                {"$project": {"file_name": 1, "_id": 0}},
+            ],
+            "as": "evidence_file",
+        }},
+        # Shape rows into their JSON form on the server so they can be serialized as-is
+        {"$addFields": {
+            "_id": {"$toString": "$_id"},
+            "payee_due_date": {"$cond": [
+                {"$eq": [{"$type": "$payee_due_date"}, "date"]},
+                {"$dateToString": {"date": "$payee_due_date", "format": "%Y-%m-%d"}},
+                "$payee_due_date",
+            ]},
+            "evidence_file": {"$cond": [
+                {"$gt": [{"$size": "$evidence_file"}, 0]},
+                {"file_found": True, "file_name": {"$arrayElemAt": ["$evidence_file.file_name", 0]}},
+                {"file_found": False, "message": "Evidence found but no file data available"},
+            ]},
+        }},
+    ], collation=collation).to_list(length=None)
+    has_more = len(results) > limit
+    results = results[:limit]
+    next_cursor = _encode_cursor(results[-1]) if has_more else None
+
+    total_count = await _count_payments(query, collation)
+
+    return {"payments": results, "totalCount": total_count, "nextCursor": next_cursor}
\ No newline at end of file
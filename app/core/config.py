@@ -4,6 +4,12 @@ from pydantic_settings import BaseSettings
 class Settings(BaseSettings):
     mongodb_uri: str
     database_name: str
+    mongodb_max_pool_size: int = 50
+    mongodb_min_pool_size: int = 10  # Connections kept warm so requests don't wait on socket setup
+    mongodb_wait_queue_timeout_ms: int = 2000
+    mongodb_server_selection_timeout_ms: int = 3000
+    mongodb_compressors: str = "zstd,zlib"  # Wire protocol compression, in order of preference
+    status_refresh_interval_seconds: int = 3600  # How often payment statuses are recomputed
     
     class Config:
         env_file = ".env"  # Load settings from .env file
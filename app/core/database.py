@@ -1,13 +1,26 @@
-from pymongo import MongoClient
+import logging
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import DESCENDING, TEXT
+from pymongo.errors import DuplicateKeyError
 from .config import settings
 from bson.son import SON
 
+logger = logging.getLogger(__name__)
+
 class MongoDB:
     def __init__(self, uri: str = settings.mongodb_uri, db_name: str = settings.database_name):
         """
         Initialize MongoDB connection and database.
         """
-        self.client = MongoClient(uri)
+        self.client = AsyncIOMotorClient(
+            uri,
+            maxPoolSize=settings.mongodb_max_pool_size,
+            minPoolSize=settings.mongodb_min_pool_size,
+            waitQueueTimeoutMS=settings.mongodb_wait_queue_timeout_ms,
+            serverSelectionTimeoutMS=settings.mongodb_server_selection_timeout_ms,
+            retryWrites=True,
+            compressors=settings.mongodb_compressors,
+        )
         self.db = self.client[db_name]
 
     def get_collection(self, collection_name: str):
@@ -16,6 +29,12 @@ class MongoDB:
         """
         return self.db[collection_name]
 
+    def get_bucket(self, bucket_name: str):
+        """
+        Get a GridFS bucket for storing file contents outside regular documents.
+        """
+        return AsyncIOMotorGridFSBucket(self.db, bucket_name=bucket_name)
+
     def close(self):
         """
         Close the MongoDB client connection.
@@ -31,3 +50,75 @@ payments_collection = db.get_collection("payments")
 
 # For evidence collection
 evidence_collection = db.get_collection("evidence")
+
+# For evidence file contents, referenced by `file_id` from the evidence collection
+evidence_bucket = db.get_bucket("evidence_files")
+
+# For the import keys of deleted CSV-imported payments, so re-imports don't bring them back
+deleted_imports_collection = db.get_collection("deleted_imports")
+
+# Text fields filterable in get_payments and covered by its `search` parameter
+PAYMENT_SEARCH_FIELDS = (
+    "payee_first_name",
+    "payee_last_name",
+    "payee_payment_status",
+    "payee_address_line_1",
+    "payee_address_line_2",
+    "payee_city",
+    "payee_country",
+    "payee_province_or_state",
+    "payee_postal_code",
+    "payee_phone_number",
+    "payee_email",
+    "currency",
+)
+
+# Case-insensitive (but accent-sensitive) comparison used by the prefix filters in get_payments
+PAYMENT_FILTER_COLLATION = {"locale": "en", "strength": 2}
+
+# Filter fields given their own index, built with PAYMENT_FILTER_COLLATION so the prefix
+# filters get tight index bounds. Status, country, currency and the like match too many
+# documents for an index to beat a collection scan.
+PAYMENT_PREFIX_INDEX_FIELDS = (
+    "payee_first_name",
+    "payee_last_name",
+    "payee_email",
+    "payee_phone_number",
+    "payee_postal_code",
+)
+
+# Identifies the source CSV row of an imported payment across repeated imports. Only the CSV
+# ingest writes it, so editing a payment through the API never changes which row it came from.
+PAYMENT_IMPORT_KEY = "import_key"
+PAYMENT_IMPORT_KEY_INDEX = "payment_import_key"
+
+
+async def ensure_indexes():
+    """
+    Create the indexes the API queries rely on. Safe to call on every startup.
+    """
+    # Supports the (payee_due_date, _id) keyset pagination and due date sort in get_payments,
+    # and the due date filters of the payment status refresh
+    await payments_collection.create_index([("payee_due_date", DESCENDING), ("_id", DESCENDING)])
+    # Inverted index backing the free-text `search` in get_payments
+    await payments_collection.create_index([(field, TEXT) for field in PAYMENT_SEARCH_FIELDS])
+    # Per-field indexes for the selective prefix filters in get_payments
+    for field in PAYMENT_PREFIX_INDEX_FIELDS:
+        await payments_collection.create_index(field, name=f"{field}_ci", collation=PAYMENT_FILTER_COLLATION)
+    # Lookup for the idempotent CSV ingest upserts. Unique, so concurrent imports can't both insert
+    # a row; sparse, as payments created through the API have no import key.
+    await payments_collection.create_index(
+        PAYMENT_IMPORT_KEY, name=PAYMENT_IMPORT_KEY_INDEX, unique=True, sparse=True
+    )
+    # Evidence is looked up by payment on every download, delete and payment listing.
+    # Unique, as a payment has a single evidence document. Databases still holding duplicates
+    # from before the index existed are left as they are until the one-off migration is run.
+    try:
+        await evidence_collection.create_index("payment_id", unique=True)
+    except DuplicateKeyError:
+        logger.error(
+            "Evidence has duplicate payment_id values, so its unique index was not created; "
+            "run `python -m migrations.dedupe_evidence` to remove the older duplicates"
+        )
+    # Filtered listings run with PAYMENT_FILTER_COLLATION, which their evidence lookup inherits
+    await evidence_collection.create_index("payment_id", name="payment_id_ci", collation=PAYMENT_FILTER_COLLATION)
@@ -1,8 +1,13 @@
+import asyncio
+import logging
 from fastapi import FastAPI
 from api.payment import router as payment_router
 from dotenv import load_dotenv
 import os
 from services.normalize_csv_service import normalize_csv
+from services.payment_status_service import refresh_payment_statuses
+from core.config import settings
+from core.database import ensure_indexes
 from fastapi.middleware.cors import CORSMiddleware
 
 # Load environment variables from .env file
@@ -19,6 +24,8 @@ app.add_middleware(
 )
 
 
+logger = logging.getLogger(__name__)
+
 # CSV file path from environment variable (can be adjusted if needed)
 CSV_FILE_PATH = os.getenv("CSV_FILE_PATH", "./payment_information.csv")
 
@@ -28,8 +35,36 @@ async def startup_event():
     This function is executed when the application starts up.
     It will normalize the data from the CSV file and save it to MongoDB.
     """
+    # The ingest upserts look rows up by the import key index, so it must exist before the load
+    await ensure_indexes()
     print(f"Normalizing data from {CSV_FILE_PATH}...")
-    normalize_csv(CSV_FILE_PATH)  # Normalize and save to MongoDB
+    await normalize_csv(CSV_FILE_PATH)  # Normalize and save to MongoDB
     print("Normalization completed.")
+    app.state.status_refresh_task = asyncio.create_task(refresh_statuses_periodically())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    Stop the background payment status refresh.
+    """
+    # Startup may have failed before the task was created
+    task = getattr(app.state, "status_refresh_task", None)
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+async def refresh_statuses_periodically():
+    """
+    Recompute payment statuses in the background so list requests never pay for it.
+    """
+    while True:
+        try:
+            await refresh_payment_statuses()
+        except Exception:
+            logger.exception("Error refreshing payment statuses")
+        await asyncio.sleep(settings.status_refresh_interval_seconds)
 
 app.include_router(payment_router, prefix="/payments", tags=["Payments"])
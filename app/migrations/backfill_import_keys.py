@@ -0,0 +1,65 @@
+"""
+One-off migration for databases imported before payments had an import key: give each payment
+still matching a CSV row by the old (payee_email, payee_due_date) key that row's import key,
+then replace the old ingest index with the unique import key index.
+
+    python -m migrations.backfill_import_keys [--csv PATH] [--dry-run]
+
+Run it before the next startup import; until then that import is skipped. CSV rows without a
+matching payment (e.g. because its email or due date was edited) are logged, and will be
+imported as new payments.
+"""
+import argparse
+import asyncio
+import logging
+import os
+from pymongo import UpdateOne
+from core.database import payments_collection, ensure_indexes, PAYMENT_IMPORT_KEY
+from services.normalize_csv_service import open_csv_reader, read_normalized_chunk, INSERT_BATCH_SIZE
+
+logger = logging.getLogger("migrations.backfill_import_keys")
+
+LEGACY_INGEST_KEY_INDEX = "payment_ingest_key"
+
+async def backfill_import_keys(file_path: str, dry_run: bool):
+    # Payments without an import key by their old ingest key, oldest first
+    legacy = {}
+    unkeyed = payments_collection.find(
+        {PAYMENT_IMPORT_KEY: {"$exists": False}}, {"payee_email": 1, "payee_due_date": 1}
+    ).sort("_id", 1)
+    async for payment in unkeyed:
+        legacy.setdefault((payment.get("payee_email"), payment.get("payee_due_date")), []).append(payment["_id"])
+
+    requests = []
+    unmatched = 0
+    with open_csv_reader(file_path) as reader:
+        while (df := read_normalized_chunk(reader)) is not None:
+            for key, email, due in zip(df[PAYMENT_IMPORT_KEY], df["payee_email"], df["payee_due_date"]):
+                ids = legacy.get((email, due.to_pydatetime()))
+                if not ids:
+                    unmatched += 1
+                    logger.info("No payment matches the CSV row of %s due %s", email, due.date())
+                    continue
+                requests.append(UpdateOne({"_id": ids.pop(0)}, {"$set": {PAYMENT_IMPORT_KEY: key}}))
+
+    logger.info(
+        "%s import keys on %d payments; %d CSV rows have no matching payment",
+        "Would set" if dry_run else "Setting", len(requests), unmatched,
+    )
+    if dry_run:
+        return
+    for start in range(0, len(requests), INSERT_BATCH_SIZE):
+        await payments_collection.bulk_write(requests[start:start + INSERT_BATCH_SIZE], ordered=False)
+
+    if LEGACY_INGEST_KEY_INDEX in await payments_collection.index_information():
+        await payments_collection.drop_index(LEGACY_INGEST_KEY_INDEX)
+        logger.info("Dropped the %s index", LEGACY_INGEST_KEY_INDEX)
+    await ensure_indexes()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add import keys to payments imported without them.")
+    parser.add_argument("--csv", default=os.getenv("CSV_FILE_PATH", "./payment_information.csv"), help="the imported CSV file")
+    parser.add_argument("--dry-run", action="store_true", help="log what would change without writing")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    args = parser.parse_args()
+    asyncio.run(backfill_import_keys(args.csv, args.dry_run))
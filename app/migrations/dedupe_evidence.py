@@ -0,0 +1,53 @@
+"""
+One-off migration: keep only the newest evidence document of each payment, deleting the
+older documents and their GridFS files, then create the unique `payment_id` index.
+
+    python -m migrations.dedupe_evidence [--dry-run]
+
+Every removed document is logged with its payment_id and file_id; with --dry-run nothing
+is deleted.
+"""
+import argparse
+import asyncio
+import logging
+from bson import ObjectId
+from gridfs.errors import NoFile
+from pymongo import DESCENDING
+from core.database import evidence_collection, evidence_bucket
+
+logger = logging.getLogger("migrations.dedupe_evidence")
+
+async def dedupe_evidence(dry_run: bool):
+    duplicates = evidence_collection.aggregate([
+        {"$sort": {"_id": DESCENDING}},  # Newest first, as ObjectIds grow with insertion time
+        {"$group": {"_id": "$payment_id", "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ], allowDiskUse=True)
+    removed = 0
+    async for group in duplicates:
+        kept_id, stale_ids = group["ids"][0], group["ids"][1:]
+        async for evidence in evidence_collection.find({"_id": {"$in": stale_ids}}, {"file_id": 1}):
+            logger.info(
+                "%s evidence %s of payment_id=%s (file_id=%s), keeping evidence %s",
+                "Would remove" if dry_run else "Removing",
+                evidence["_id"], group["_id"], evidence.get("file_id"), kept_id,
+            )
+            if not dry_run and evidence.get("file_id"):
+                try:
+                    await evidence_bucket.delete(ObjectId(evidence["file_id"]))
+                except NoFile:
+                    logger.warning("GridFS file %s was already missing", evidence["file_id"])
+        if not dry_run:
+            await evidence_collection.delete_many({"_id": {"$in": stale_ids}})
+        removed += len(stale_ids)
+
+    logger.info("%s %d duplicate evidence documents", "Would remove" if dry_run else "Removed", removed)
+    if not dry_run:
+        await evidence_collection.create_index("payment_id", unique=True)
+        logger.info("Created the unique evidence payment_id index")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Remove duplicate evidence documents per payment.")
+    parser.add_argument("--dry-run", action="store_true", help="log what would be removed without deleting")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    asyncio.run(dedupe_evidence(parser.parse_args().dry_run))
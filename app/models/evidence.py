@@ -4,5 +4,5 @@ from typing import Optional
 class Evidence(BaseModel):
     payment_id: str
     file_name: str
-    file_data: bytes
+    file_id: str  # GridFS id of the file contents
     file_type: str
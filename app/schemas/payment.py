@@ -1,6 +1,7 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_serializer
 from datetime import date, datetime
-from typing import Optional
+from typing import Any, Dict, List, Optional
+from models.payment import Payment
 
 class PaymentCreateResponse(BaseModel):
     payment_id: str
@@ -24,5 +25,24 @@ class PaymentCreateRequest(BaseModel):
     tax_percent: Optional[float]
     due_amount: float
 
+    # Dump into the formats stored in the payments collection
+    @field_serializer("payee_added_date_utc")
+    def serialize_payee_added_date_utc(self, value: datetime):
+        return value.strftime("%b %d, %Y, %I:%M %p")
+
+    @field_serializer("payee_due_date")
+    def serialize_payee_due_date(self, value: date):
+        return datetime.combine(value, datetime.min.time())
+
 class PaymentUpdateRequest(PaymentCreateRequest):
     pass  # Same schema, but for updates
+
+class PaymentListItem(Payment):
+    id: str = Field(alias="_id")
+    payee_due_date: str  # Formatted as YYYY-MM-DD by the listing query
+    evidence_file: Dict[str, Any]
+
+class PaymentListResponse(BaseModel):
+    payments: List[PaymentListItem]
+    totalCount: int
+    nextCursor: Optional[str]
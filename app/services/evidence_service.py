@@ -1,25 +1,68 @@
 import os
 import bson
 from models.evidence import Evidence
-from core.database import evidence_collection, payments_collection
+from core.database import evidence_collection, evidence_bucket, payments_collection
 from bson import ObjectId
+from gridfs.errors import NoFile
+from pydantic import ValidationError
 from fastapi.encoders import jsonable_encoder
 from fastapi import HTTPException, File, UploadFile
-from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
 from io import BytesIO
 from fastapi.responses import JSONResponse
 
-def uploading_evidence(payment_id: str, file_data: bytes, file_name: str, file_type: str):
-    evidence = Evidence(payment_id=payment_id, file_name=file_name, file_data=file_data, file_type=file_type)
-    evidence_collection.insert_one(evidence.dict())
-    payments_collection.update_one(
-        {"_id": ObjectId(payment_id)},  # Match the payment by payment_id
+UPLOAD_CHUNK_SIZE = 1 << 20  # Read uploads 1 MiB at a time
+
+async def uploading_evidence(payment_id: str, file: UploadFile):
+    # Check everything the evidence document needs before storing any bytes,
+    # so a bad request can't leave an orphaned GridFS file
+    try:
+        payment_object_id = ObjectId(payment_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid payment ID format")
+    file_id = ObjectId()
+    try:
+        evidence = Evidence(
+            payment_id=payment_id,
+            file_name=file.filename,
+            file_id=str(file_id),
+            file_type=file.content_type or "application/octet-stream",  # Not every client sends one
+        )
+    except ValidationError:
+        raise HTTPException(status_code=400, detail="Invalid evidence file")
+
+    # Stream the file contents into GridFS; the evidence document only references them
+    grid_in = evidence_bucket.open_upload_stream_with_id(
+        file_id, evidence.file_name, metadata={"payment_id": payment_id, "content_type": evidence.file_type}
+    )
+    try:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        while chunk:
+            await grid_in.write(chunk)
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+    except Exception:
+        await grid_in.abort()
+        raise
+    await grid_in.close()
+
+    # A payment has a single evidence document; a new upload replaces the previous file
+    try:
+        previous = await evidence_collection.find_one_and_replace(
+            {"payment_id": payment_id}, evidence.model_dump(), projection={"file_id": 1}, upsert=True
+        )
+    except Exception:
+        await _delete_file(evidence.model_dump())  # Not referenced by any evidence document
+        raise
+    if previous:
+        await _delete_file(previous)
+    await payments_collection.update_one(
+        {"_id": payment_object_id},  # Match the payment by payment_id
         {"$set": {"payee_payment_status": "completed"}}  # Set the status to "completed"
     )
     return {"file_id": str(evidence.payment_id)}
 
-def get_evidence(payment_id: str):
-    evidence = evidence_collection.find_one({"payment_id": payment_id})
+async def get_evidence(payment_id: str):
+    evidence = await evidence_collection.find_one({"payment_id": payment_id})
 
     if not evidence:
         return JSONResponse(status_code=400, content={"message": "Evidence found but no file data available"})
@@ -27,15 +70,41 @@ def get_evidence(payment_id: str):
     if evidence:
         evidence["_id"] = str(evidence["_id"])  # Convert ObjectId to string
 
-    # If file_data is stored as bytes, convert it to a file-like object
+    headers = {"Content-Disposition": f'attachment; filename="{evidence["file_name"]}"'}
+
+    if evidence.get("file_id"):
+        try:
+            grid_out = await evidence_bucket.open_download_stream(ObjectId(evidence["file_id"]))
+        except NoFile:
+            return JSONResponse(status_code=400, content={"message": "Evidence found but no file data available"})
+        return StreamingResponse(_read_chunks(grid_out), media_type=evidence["file_type"], headers=headers)
+
+    # Evidence uploaded before GridFS storage still keeps its bytes inline
     file_data = evidence.get("file_data")
-    
+
     if file_data:
-        # Option 1: Save the file temporarily and return its path (for large files)
-        temp_file_path = "/tmp/temp_file"
-        with open(temp_file_path, "wb") as f:
-            f.write(file_data)
-        
-        return FileResponse(temp_file_path, media_type=evidence["file_type"], headers={"Content-Disposition": f"attachment; filename={evidence['file_name']}"})
+        # Serve the bytes already in memory rather than round-tripping them through a temp file
+        return StreamingResponse(BytesIO(file_data), media_type=evidence["file_type"], headers=headers)
     
     return JSONResponse(status_code=400, content={"message": "Evidence found but no file data available"})
+
+async def delete_evidence(payment_id: str):
+    # Remove the evidence document and its GridFS contents; returns whether evidence existed
+    evidence = await evidence_collection.find_one_and_delete({"payment_id": payment_id}, projection={"file_id": 1})
+    if evidence:
+        await _delete_file(evidence)
+    return evidence is not None
+
+async def _delete_file(evidence):
+    if evidence.get("file_id"):
+        try:
+            await evidence_bucket.delete(ObjectId(evidence["file_id"]))
+        except NoFile:
+            pass
+
+async def _read_chunks(grid_out):
+    # Yield the stored GridFS chunks one at a time instead of loading the whole file
+    chunk = await grid_out.readchunk()
+    while chunk:
+        yield chunk
+        chunk = await grid_out.readchunk()
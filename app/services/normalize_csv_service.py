@@ -1,45 +1,299 @@
+import asyncio
+import hashlib
+import logging
+import typing
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pa_csv
 from datetime import date
 from models.payment import Payment
 from models.evidence import Evidence
-from core.database import payments_collection
+from core.database import payments_collection, deleted_imports_collection, ensure_indexes, PAYMENT_IMPORT_KEY
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from pymongo.write_concern import WriteConcern
 from schemas.payment import PaymentCreateRequest, PaymentUpdateRequest
 from datetime import datetime
 
-def normalize_csv(file_path: str):
-    # Step 1: Read the CSV file into a pandas DataFrame
-    df = pd.read_csv(file_path)
+logger = logging.getLogger(__name__)
 
-    # Step 2: Normalize the data
+try:
+    import numexpr
+except ImportError:  # Optional: fall back to Numba, then plain NumPy arithmetic
+    numexpr = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _total_due_kernel(due, discount, tax, out):
+        for i in prange(due.shape[0]):
+            out[i] = round(due[i] - due[i] * (discount[i] / 100.0) + due[i] * (tax[i] / 100.0), 2)
+
+CSV_BLOCK_SIZE = 2 << 20  # Bytes of CSV parsed, normalized and inserted at a time (~10k rows)
+INSERT_BATCH_SIZE = 2_000  # Documents per bulk write
+MAX_CONCURRENT_INSERTS = 10  # Batches in flight at once, to avoid overwhelming the primary
+PIPELINE_DEPTH = 2  # Normalized chunks allowed to wait for insertion
+# float32 holds 0-100 to within 1e-5, so rounding to 4 places restores the CSV's values when storing
+FLOAT32_STORED_DECIMALS = 4
+# The source CSV can always be re-ingested, so don't wait on the journal for each insert
+INGEST_WRITE_CONCERN = WriteConcern(w=1, j=False)
+
+# Read only the Payment columns (total_due is derived), with their types declared up front
+CSV_COLUMNS = [field for field in Payment.model_fields if field != 'total_due']
+CSV_COLUMN_TYPES = {
+    'payee_first_name': pa.string(),
+    'payee_last_name': pa.string(),
+    'payee_payment_status': pa.string(),
+    'payee_added_date_utc': pa.string(),  # Numeric columns are coerced in normalize_chunk
+    'payee_due_date': pa.string(),  # Parsed leniently in normalize_chunk
+    'payee_address_line_1': pa.string(),
+    'payee_address_line_2': pa.string(),
+    'payee_city': pa.string(),
+    # ~200 distinct codes, stored once each instead of per row (a pandas category)
+    'payee_country': pa.dictionary(pa.int32(), pa.string()),
+    'payee_province_or_state': pa.string(),
+    'payee_postal_code': pa.string(),
+    'payee_phone_number': pa.string(),
+    'payee_email': pa.string(),
+    'currency': pa.string(),
+    'discount_percent': pa.string(),
+    'tax_percent': pa.string(),
+    'due_amount': pa.string(),
+}
+# Numeric columns are read as text and coerced per column, so a malformed cell becomes a
+# missing value for validate_chunk instead of failing the whole read.
+# Percentages (0-100) are held as float32 to halve their memory; money stays float64, as do
+# the epoch seconds (exact below 2**53, and able to hold NaN)
+CSV_NUMERIC_TYPES = {
+    'payee_added_date_utc': np.float64,
+    'discount_percent': np.float32,
+    'tax_percent': np.float32,
+    'due_amount': np.float64,
+}
+
+# Payment fields that may be null in stored documents; every other field must be present
+NULLABLE_FIELDS = [
+    field for field, info in Payment.model_fields.items()
+    if type(None) in typing.get_args(info.annotation)
+]
+REQUIRED_FIELDS = [field for field in Payment.model_fields if field not in NULLABLE_FIELDS]
+
+# Raw CSV columns hashed into each row's import key. Changing them changes every row's key,
+# and the next import would then insert the whole file again.
+IMPORT_KEY_COLUMNS = list(CSV_COLUMNS)
+DUPLICATE_KEY_ERROR = 11000
+
+async def normalize_csv(file_path: str):
+    # For the first load into an empty collection, secondary indexes are dropped and rebuilt
+    # once afterwards, rather than being updated for every inserted document. Later imports
+    # upsert rows that are already stored and write next to nothing, so they keep the indexes.
+    bulk_load = await payments_collection.find_one({}, {"_id": 1}) is None
+    # Rows whose imported payment was deleted through the API stay deleted
+    deleted_keys = {doc["_id"] async for doc in deleted_imports_collection.find({}, {"_id": 1})}
+    if not bulk_load:
+        if not deleted_keys and await payments_collection.find_one({PAYMENT_IMPORT_KEY: {"$exists": True}}, {"_id": 1}) is None:
+            # Imported before rows had import keys: upserting now would insert every row again
+            logger.error(
+                "Payments were imported without import keys, so the CSV import is skipped; "
+                "run `python -m migrations.backfill_import_keys` to add them"
+            )
+            return
+        await load_csv(file_path, deleted_keys)
+        return
+    await drop_secondary_indexes()
+    try:
+        await load_csv(file_path, deleted_keys)
+    finally:
+        await ensure_indexes()
+
+async def drop_secondary_indexes():
+    # Unique indexes (and `_id`) stay in place so they keep enforcing constraints during the load,
+    # including the import key index that every upsert looks rows up by
+    async for index in payments_collection.list_indexes():
+        if index["name"] != "_id_" and not index.get("unique"):
+            await payments_collection.drop_index(index["name"])
+
+def open_csv_reader(file_path: str):
+    # Stream the Payment columns of the CSV as Arrow record batches
+    return pa_csv.open_csv(
+        file_path,
+        read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=CSV_COLUMNS,
+            column_types=CSV_COLUMN_TYPES,
+            # Only empty fields are missing values; literal "NA", "null", ... are kept, as they
+            # can be real data (Namibia's country code, a payee named Nan)
+            null_values=[''],
+            strings_can_be_null=True,
+        ),
+    )
+
+async def load_csv(file_path: str, deleted_keys=frozenset()):
+    # Step 1: Read the CSV file in chunks so memory is bounded by the chunk size, not the file.
+    # Arrow's multi-threaded C++ parser streams the file block by block. Parsing and
+    # normalizing run in a worker thread while the previous chunk is inserted, so MongoDB
+    # latency overlaps with the pandas work.
+    with open_csv_reader(file_path) as reader:
+        chunks = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+        stopping = False
+
+        async def produce():
+            try:
+                while not stopping and (df := await asyncio.to_thread(read_normalized_chunk, reader, deleted_keys)) is not None:
+                    await chunks.put(df)
+            finally:
+                if not stopping:
+                    await chunks.put(None)  # Also on error, so the consumer stops waiting
+
+        producer = asyncio.create_task(produce())
+        try:
+            while (df := await chunks.get()) is not None:
+                # Step 5: Save normalized data into MongoDB
+                await save_to_normalize_csv_to_db(df)
+        except BaseException:
+            # The producer isn't cancelled: its worker thread can't be interrupted and must be
+            # done with the reader before the `with` block closes it. Ask it to stop, free any
+            # put it's blocked in, and wait for its current read to finish.
+            stopping = True
+            while not chunks.empty():
+                chunks.get_nowait()
+            await asyncio.gather(producer, return_exceptions=True)
+            raise
+        await producer  # Surface any parsing error
+
+def read_normalized_chunk(reader, deleted_keys=frozenset()):
+    # Parse the next CSV chunk and prepare it for insertion; None once the file is exhausted
+    try:
+        batch = reader.read_next_batch()
+    except StopIteration:
+        return None
+    df = batch.to_pandas()
+    df[PAYMENT_IMPORT_KEY] = import_keys(df)
+    if deleted_keys:
+        df.drop(index=df.index[df[PAYMENT_IMPORT_KEY].isin(deleted_keys)], inplace=True)
+    normalize_chunk(df)
+    validate_chunk(df)
+    return df
+
+def import_keys(df: pd.DataFrame):
+    # Hash each row's raw CSV text (every column is still text before normalize_chunk), so a
+    # row keeps its key however its payment is edited later and a changed row gets a new one
+    first, *rest = (df[column].astype(object) for column in IMPORT_KEY_COLUMNS)
+    rows = first.str.cat(rest, sep='\x1f', na_rep='')
+    return [hashlib.blake2b(row.encode(), digest_size=16).hexdigest() for row in rows]
+
+def normalize_chunk(df: pd.DataFrame):
+    # Step 2: Normalize the data in place
     # Ensure the fields are in the correct format (e.g., dates, numbers)
-    df['payee_added_date_utc'] = pd.to_datetime(df['payee_added_date_utc'], unit='s').dt.strftime('%b %d, %Y, %I:%M %p')
+    for field, dtype in CSV_NUMERIC_TYPES.items():
+        df[field] = pd.to_numeric(df[field], errors='coerce').astype(dtype)
+    df['payee_added_date_utc'] = format_added_dates(df['payee_added_date_utc'])
+    # (values that fail to parse become NaN, and due dates NaT)
     df['payee_due_date'] = pd.to_datetime(df['payee_due_date'], format='%Y-%m-%d', errors='coerce')
-    df['discount_percent'] = pd.to_numeric(df['discount_percent'], errors='coerce').fillna(0)
-    df['tax_percent'] = pd.to_numeric(df['tax_percent'], errors='coerce').fillna(0)
-    df['due_amount'] = pd.to_numeric(df['due_amount'], errors='coerce')
+    # Missing or negative percentages count as 0, so total_due needs no per-value checks
+    df[['discount_percent', 'tax_percent']] = df[['discount_percent', 'tax_percent']].fillna(0).clip(lower=0)
     
     # Step 3: Calculate 'total_due' based on discount, tax, and due_amount
-    df['total_due'] = df.apply(calculate_total_due, axis=1)
+    # (column-wise over the float arrays)
+    df['total_due'] = calculate_total_due(
+        df['due_amount'].to_numpy(),
+        df['discount_percent'].to_numpy(),
+        df['tax_percent'].to_numpy(),
+    )
     
     # Step 4: Fill missing or optional fields (handle missing values if necessary)
     df['payee_address_line_2'] = df['payee_address_line_2'].fillna('')
-    df['payee_postal_code'] = df['payee_postal_code'].astype(str)
-    df['payee_phone_number'] = df['payee_phone_number'].astype(str)
-    df['payee_country'] = df['payee_country'].astype(str)
-    
-    
-    # Step 5: Save normalized data into MongoDB
-    save_to_normalize_csv_to_db(df)
-
-def save_to_normalize_csv_to_db(df: pd.DataFrame):
-    # Convert DataFrame rows to Payment model format and insert into MongoDB
-    for _, row in df.iterrows():
-        payment_data = row.to_dict()
-        payment = Payment(**payment_data)
-        payments_collection.insert_one(payment.dict())
-
-def calculate_total_due(row):
-    # Apply discount and tax calculations
-    discount = row.discount_percent if row.discount_percent else 0
-    tax = row.tax_percent if row.tax_percent else 0
-    return round(row.due_amount * (1 - discount / 100) * (1 + tax / 100), 2)
+    df['payee_postal_code'] = df['payee_postal_code'].fillna('')
+    df['payee_phone_number'] = df['payee_phone_number'].fillna('')
+    if df['payee_country'].isna().any():
+        df['payee_country'] = df['payee_country'].cat.add_categories('').fillna('')
+
+def calculate_total_due(due, discount, tax):
+    # Apply discount and tax calculations over whole arrays. NumExpr evaluates the
+    # expression in one multi-threaded pass without NumPy's intermediate arrays;
+    # the compiled Numba kernel does the same when NumExpr is not installed.
+    # Same formula and operation order as TOTAL_DUE_EXPRESSION in api/payment.py, so the
+    # stored total matches the one get_payments serves.
+    # The float32 percentages are widened first: under NumPy 2 promotion rules they would
+    # otherwise keep the arithmetic in float32 and round some totals a cent off. They are
+    # rounded as column_for_bson stores them, so both totals start from the same values.
+    discount = np.round(discount.astype(np.float64), FLOAT32_STORED_DECIMALS)
+    tax = np.round(tax.astype(np.float64), FLOAT32_STORED_DECIMALS)
+    if numexpr is not None:
+        total_due = numexpr.evaluate('due - due * (discount / 100.0) + due * (tax / 100.0)')
+    elif njit is not None:
+        out = np.empty(due.shape[0], dtype=np.float64)
+        _total_due_kernel(due, discount, tax, out)
+        return out
+    else:
+        total_due = due - due * (discount / 100.0) + due * (tax / 100.0)
+    return np.round(total_due, 2)
+
+def validate_chunk(df: pd.DataFrame):
+    # Column-wise stand-in for validating each row through the Payment model: the dtypes are
+    # fixed by the CSV reader, so only missing values need checking. Rows missing a required
+    # field are dropped and nulls in optional fields become None for BSON.
+    invalid = df[REQUIRED_FIELDS].isna().any(axis=1)
+    if invalid.any():
+        print(f"Skipping {int(invalid.sum())} CSV rows with missing required fields")
+        df.drop(index=df.index[invalid], inplace=True)
+
+    for field in NULLABLE_FIELDS:
+        if df[field].isna().any():
+            df[field] = df[field].astype(object).where(df[field].notna(), None)
+
+def format_added_dates(epoch_seconds: pd.Series):
+    # Format each distinct timestamp once (batch imports repeat them heavily) into the
+    # display string stored in `payee_added_date_utc`, then map the strings back to the rows.
+    # The distinct epoch seconds are cast to datetime64[s] with no per-value conversion.
+    # Missing timestamps get code -1; they map to NaN so validate_chunk drops the row.
+    codes, unique_seconds = pd.factorize(epoch_seconds.to_numpy())
+    formatted = pd.Series(unique_seconds.astype('datetime64[s]')).dt.strftime('%b %d, %Y, %I:%M %p')
+    lookup = np.append(formatted.to_numpy(dtype=object), np.nan)
+    return pd.Series(lookup[codes], index=epoch_seconds.index)
+
+def column_for_bson(column: pd.Series):
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return column.to_numpy(dtype=object)
+    if column.dtype == np.float32:
+        return np.round(column.to_numpy(dtype=np.float64), FLOAT32_STORED_DECIMALS)
+    return column.to_numpy()
+
+async def save_to_normalize_csv_to_db(df: pd.DataFrame):
+    # Convert the validated DataFrame rows straight into Payment documents for MongoDB by
+    # zipping the column arrays, without building a Series or boxing every cell per row.
+    # Datetime columns are taken as objects (Timestamps) and float32 columns widened back
+    # to float64, as BSON only encodes native datetimes and doubles.
+    columns = df.columns.tolist()
+    arrays = [column_for_bson(df[column]) for column in columns]
+
+    # Bulk write in batches, several in flight at once; unordered so one bad row doesn't stop the rest.
+    # Each batch's documents are only built once it may be sent, so at most
+    # MAX_CONCURRENT_INSERTS batches of dicts exist at a time rather than the whole chunk.
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_INSERTS)
+    collection = payments_collection.with_options(write_concern=INGEST_WRITE_CONCERN)
+
+    async def insert_batch(start):
+        async with semaphore:
+            rows = zip(*(array[start:start + INSERT_BATCH_SIZE] for array in arrays))
+            # Upsert on the import key so re-running the import (e.g. on every startup) doesn't
+            # duplicate rows; rows already stored, edited or not, are left untouched
+            requests = [
+                UpdateOne({PAYMENT_IMPORT_KEY: payment[PAYMENT_IMPORT_KEY]}, {"$setOnInsert": payment}, upsert=True)
+                for payment in (dict(zip(columns, row)) for row in rows)
+            ]
+            try:
+                await collection.bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                # A concurrent import inserted the same rows first, which is all the upserts wanted
+                if e.details.get("writeConcernErrors") or any(
+                    error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]
+                ):
+                    raise
+
+    await asyncio.gather(*(insert_batch(start) for start in range(0, len(df), INSERT_BATCH_SIZE)))
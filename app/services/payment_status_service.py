@@ -0,0 +1,34 @@
+from datetime import date, datetime
+from functools import lru_cache
+from pymongo import UpdateMany
+from pymongo.write_concern import WriteConcern
+from core.database import payments_collection
+
+@lru_cache(maxsize=1)
+def _midnight(ordinal: int):
+    return datetime.fromordinal(ordinal)
+
+def today_midnight():
+    """
+    Today's date as a midnight datetime, matching how `payee_due_date` is stored.
+    """
+    return _midnight(date.today().toordinal())
+
+async def refresh_payment_statuses():
+    """
+    Mark unpaid payments as `due_now` or `overdue` based on `payee_due_date`.
+    """
+    today = today_midnight()
+
+    # Update `payee_payment_status` based on `payee_due_date` in one round trip.
+    # The refresh is best effort and re-runs on the next interval, so skip waiting on the journal.
+    await payments_collection.with_options(write_concern=WriteConcern(w=1, j=False)).bulk_write([
+        UpdateMany(
+            {"payee_due_date": {"$eq": today}, "payee_payment_status": {"$ne": "completed"}},
+            {"$set": {"payee_payment_status": "due_now"}}
+        ),
+        UpdateMany(
+            {"payee_due_date": {"$lt": today}, "payee_payment_status": {"$ne": "completed"}},
+            {"$set": {"payee_payment_status": "overdue"}}
+        ),
+    ], ordered=False)